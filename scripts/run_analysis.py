@@ -3,16 +3,76 @@
 
 import os
 import argparse
+import logging
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # 添加项目根目录到Python路径
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 from stock_analysis.utils import setup_logging, load_config
 from stock_analysis.data import get_stock_data_with_cache
-from stock_analysis.indicators import process_stock_data
 from stock_analysis.strategies import analyze_buy_strategy
-from stock_analysis.reporting import send_email_report, send_error_email
+
+def process_symbol(symbol, api_key, config, args, reporter=None):
+    """处理单只股票：获取数据、分析策略并发送邮件报告"""
+    logger = logging.getLogger("stock_analysis")
+    try:
+        symbol_name = config.get('symbol_names', {}).get(symbol, symbol)
+        logger.info(f"开始处理 {symbol} ({symbol_name})...")
+        
+        # 获取股票数据及技术指标
+        stock_data = get_stock_data_with_cache(
+            symbol, 
+            api_key, 
+            cache_expiry_hours=args.cache_expiry
+        )
+        
+        # 分析买入策略
+        strategy_params = config.get('strategy', {})
+        analysis_result = analyze_buy_strategy(stock_data, strategy_params)
+        
+        # 是否发送邮件
+        email_result = None
+        if not args.no_email:
+            from stock_analysis.reporting import send_email_report
+            email_config = config.get('email', {})
+            email_result = send_email_report(
+                stock_data, 
+                analysis_result, 
+                email_config, 
+                symbol_name,
+                reporter
+            )
+        
+        # 处理结果
+        result = {
+            "symbol": symbol,
+            "symbol_name": symbol_name,
+            "status": "success",
+            "analysis": analysis_result
+        }
+        
+        if email_result:
+            result["email"] = email_result
+            
+        logger.info(f"{symbol} 处理完成")
+        return result
+        
+    except Exception as e:
+        logger.error(f"{symbol} 处理失败: {str(e)}", exc_info=True)
+        # 发送错误报告邮件
+        if not args.no_email:
+            from stock_analysis.reporting import send_error_email
+            email_config = config.get('email', {})
+            send_error_email(symbol, str(e), email_config, reporter)
+        
+        return {
+            "symbol": symbol,
+            "status": "error",
+            "error": str(e)
+        }
 
 def main():
     """主程序入口"""
@@ -25,7 +85,7 @@ def main():
     parser.add_argument('--symbol', type=str, help='分析特定股票代码，例如：TSLA')
     parser.add_argument('--symbols', type=str, help='分析多只股票，逗号分隔，例如：TSLA,AAPL,NVDA')
     parser.add_argument('--no-email', action='store_true', help='不发送邮件，仅进行分析')
-    parser.add_argument('--cache-expiry', type=int, default=4, help='缓存过期时间(小时)')
+    parser.add_argument('--cache-expiry', type=int, default=4, help='最新行情缓存过期时间(小时)，过期后增量更新日线数据')
     args = parser.parse_args()
     
     # 加载配置
@@ -47,64 +107,35 @@ def main():
         logger.error("缺少Alpha Vantage API密钥，请在配置文件设置或通过环境变量ALPHA_VANTAGE_API_KEY提供")
         return {"status": "error", "error": "缺少API密钥"}
     
-    # 处理每只股票
-    results = []
-    for symbol in symbols_to_analyze:
-        try:
-            symbol_name = config.get('symbol_names', {}).get(symbol, symbol)
-            logger.info(f"开始处理 {symbol} ({symbol_name})...")
-            
-            # 获取股票数据
-            stock_data = get_stock_data_with_cache(
-                symbol, 
-                api_key, 
-                cache_expiry_hours=args.cache_expiry
-            )
-            
-            # 处理股票数据，计算技术指标
-            stock_data = process_stock_data(stock_data)
-            
-            # 分析买入策略
-            strategy_params = config.get('strategy', {})
-            analysis_result = analyze_buy_strategy(stock_data, strategy_params)
-            
-            # 是否发送邮件
-            email_result = None
-            if not args.no_email:
-                email_config = config.get('email', {})
-                email_result = send_email_report(
-                    stock_data, 
-                    analysis_result, 
-                    email_config, 
-                    symbol_name
-                )
-            
-            # 将结果添加到列表
-            result = {
-                "symbol": symbol,
-                "symbol_name": symbol_name,
-                "status": "success",
-                "analysis": analysis_result
+    # 并行处理每只股票（各股票之间相互独立，主要耗时为网络I/O）
+    # 所有邮件共享同一个SMTP连接，仅在首次发送时登录
+    # 邮件报告模块（依赖jinja2/matplotlib）仅在需要发送邮件时导入
+    # 图表绘制和HTML渲染直接在各股票的工作线程中进行：图表通常命中缓存，绘制本身
+    # 也只需几百毫秒，远小于启动子进程并重新导入pandas/numba/matplotlib的开销
+    reporter = None
+    if not args.no_email:
+        from stock_analysis.reporting import SmtpReporter
+        reporter = SmtpReporter(config.get('email', {}))
+        if reporter.configured:
+            # SMTP握手和登录与数据获取、图表生成同时进行，首封邮件无需等待登录
+            threading.Thread(target=reporter.connect, name="smtp-connect", daemon=True).start()
+    
+    results_by_symbol = {}
+    max_workers = max(1, min(8, len(symbols_to_analyze)))
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                executor.submit(process_symbol, symbol, api_key, config, args, reporter): symbol
+                for symbol in symbols_to_analyze
             }
-            
-            if email_result:
-                result["email"] = email_result
-                
-            results.append(result)
-            logger.info(f"{symbol} 处理完成")
-            
-        except Exception as e:
-            logger.error(f"{symbol} 处理失败: {str(e)}", exc_info=True)
-            # 发送错误报告邮件
-            if not args.no_email:
-                email_config = config.get('email', {})
-                send_error_email(symbol, str(e), email_config)
-            
-            results.append({
-                "symbol": symbol,
-                "status": "error",
-                "error": str(e)
-            })
+            for future in as_completed(futures):
+                results_by_symbol[futures[future]] = future.result()
+    finally:
+        if reporter is not None:
+            reporter.close()
+    
+    # 按输入顺序整理结果
+    results = [results_by_symbol[symbol] for symbol in symbols_to_analyze]
     
     # 汇总报告
     success_count = sum(1 for r in results if r["status"] == "success")
@@ -0,0 +1,20 @@
+"""numba JIT编译支持
+
+numba为可选依赖：已安装时使用 numba.njit 编译数值计算内核，
+未安装时退化为普通Python函数，计算结果保持一致。
+"""
+
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:  # pragma: no cover - 取决于运行环境
+    NUMBA_AVAILABLE = False
+
+    def njit(*args, **kwargs):
+        """numba不可用时的空装饰器，兼容 @njit 与 @njit(cache=True) 两种写法"""
+        if len(args) == 1 and callable(args[0]) and not kwargs:
+            return args[0]
+
+        def decorator(func):
+            return func
+        return decorator
@@ -0,0 +1,7 @@
+"""各模块共用的常量（不依赖任何第三方库，可以在任意模块中导入）"""
+
+# 报告股价图表显示的最近交易日数，图表绘制及其缓存键均以此为默认窗口
+CHART_DAYS = 30
+
+# 报告图表用到的列；get_stock_data_with_cache返回的DataFrame只保留这些列的最近CHART_DAYS行
+RECENT_DF_COLUMNS = ['close', 'ma50', 'ma200']
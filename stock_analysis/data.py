@@ -1,141 +1,423 @@
 """数据获取和处理模块"""
 
+import io
 import os
-import pickle
+import json
 import time
 import logging
+import sqlite3
+import itertools
+import threading
+import zlib
+from contextlib import closing
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import numpy as np
 import pandas as pd
-from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+try:
+    import orjson  # 可选依赖，解析大体积JSON响应更快
+except ImportError:
+    orjson = None
+
+from stock_analysis.constants import CHART_DAYS, RECENT_DF_COLUMNS
+from stock_analysis.indicators import INDICATOR_COLUMNS, INDICATORS_VERSION, process_stock_data
 
 logger = logging.getLogger(__name__)
 
+# 同时进行的API请求数量上限（所有股票共享）
+MAX_CONCURRENT_REQUESTS = 5
+
+# 所有股票的API请求统一提交到同一个线程池并发执行，线程数即并发上限
+_api_executor = ThreadPoolExecutor(
+    max_workers=MAX_CONCURRENT_REQUESTS,
+    thread_name_prefix="alphavantage"
+)
+
+# 复用HTTP连接（keep-alive），避免每次请求重新进行TCP和TLS握手；
+# 连接错误和429/5xx响应由连接适配器按指数退避自动重试
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(
+    pool_connections=1,
+    pool_maxsize=MAX_CONCURRENT_REQUESTS,
+    max_retries=Retry(total=3, backoff_factor=2, status_forcelist=[429, 500, 502, 503, 504])
+))
+_session.headers.update({'Accept-Encoding': 'gzip', 'Connection': 'keep-alive'})
+
 def get_api_data(url, max_retries=3, retry_delay=10):
-    """带重试机制的API请求函数"""
+    """带重试机制的API请求函数
+
+    网络层的重试由_session完成，这里只处理频率限制提示（HTTP 200但返回Note）。
+    请求CSV格式（datatype=csv）时返回响应的原始字节；接口出错或触发频率限制时
+    仍返回JSON，此时与其他请求一样返回解析后的dict。
+    """
+    csv_requested = "datatype=csv" in url
     
     for attempt in range(max_retries):
         try:
-            response = requests.get(url)
-            data = response.json()
-            
-            # 检查是否返回了有效内容
-            if "Note" in data and "API call frequency" in data["Note"]:
-                logger.warning(f"API频率限制触发：{data['Note']}")
-                time.sleep(retry_delay * (attempt + 1))  # 指数退避
-                continue
-                
-            return data
+            response = _session.get(url, timeout=(3, 30))
+            if csv_requested and not response.content.lstrip().startswith(b"{"):
+                return response.content
+            data = orjson.loads(response.content) if orjson is not None else response.json()
         except Exception as e:
-            logger.error(f"API请求失败 (尝试 {attempt+1}/{max_retries}): {str(e)}")
-            if attempt < max_retries - 1:
-                time.sleep(retry_delay)
-            else:
-                raise
+            logger.error(f"API请求失败: {str(e)}")
+            raise
+        
+        # 检查是否返回了有效内容
+        if "Note" in data and "API call frequency" in data["Note"]:
+            logger.warning(f"API频率限制触发：{data['Note']} (尝试 {attempt+1}/{max_retries})")
+            time.sleep(retry_delay * (attempt + 1))  # 指数退避
+            continue
+            
+        return data
 
 def detect_price_anomalies(df, threshold=0.15):
-    """检测历史数据中异常价格变动"""
-    # 确保数据按日期排序
-    df = df.sort_index()
-    
-    # 计算每日价格变动百分比
-    df['price_change_pct'] = df['close'].pct_change() * 100
-    
-    # 检查是否有任何一天价格变动超过阈值(正负)
-    large_changes = df[abs(df['price_change_pct']) > threshold * 100]
-    
+    """检测历史数据中异常价格变动（df需已按日期升序排列，不会被修改）"""
     result = {
         "detected": False,
         "date": None,
         "change_pct": None
     }
     
-    if not large_changes.empty:
-        # 找出最大变动的日期
-        max_change_idx = large_changes['price_change_pct'].abs().idxmax()
-        change_pct = large_changes.loc[max_change_idx, 'price_change_pct']
-        
+    close = df['close'].to_numpy(dtype=np.float64)
+    if len(close) < 2:
+        return result
+    
+    # 计算每日价格变动百分比（在预分配数组上原地计算，不产生中间数组）
+    pct = np.empty_like(close)
+    pct[0] = np.nan
+    np.subtract(close[1:], close[:-1], out=pct[1:])
+    pct[1:] /= close[:-1]
+    pct[1:] *= 100
+    
+    # 找出最大变动的日期，检查其变动是否超过阈值(正负)
+    i = np.nanargmax(np.abs(pct))
+    if abs(pct[i]) > threshold * 100:
         result["detected"] = True
-        result["date"] = max_change_idx.strftime("%Y-%m-%d")
-        result["change_pct"] = round(change_pct, 2)
+        result["date"] = df.index[i].strftime("%Y-%m-%d")
+        result["change_pct"] = round(pct[i], 2)
     
     return result
 
-def get_stock_data_with_cache(symbol, api_key, cache_dir="cache", cache_expiry_hours=4):
-    """获取股票数据，支持本地缓存"""
+# 原始OHLCV列，指标版本变化时据此重新计算技术指标
+OHLCV_COLUMNS = ['open', 'high', 'low', 'close', 'volume']
+
+# get_stock_data_with_cache返回的DataFrame只保留报告图表用到的最近CHART_DAYS个交易日和列
+# （52周价格区间、价格异常等统计已在完整数据上算好），完整的历史数据和技术指标
+# 保存在缓存数据库中
+def _recent_df(df):
+    """截取报告所需的最近数据（复制，不引用完整的DataFrame）"""
+    return df.iloc[-CHART_DAYS:][RECENT_DF_COLUMNS].copy()
+
+# 所有股票共用一个SQLite缓存数据库：bars表按(symbol, date)保存日线数据及技术指标，
+# meta表保存每只股票的标量字段、指标版本、获取时间和指标递推状态（JSON）
+CACHE_DB_NAME = "stocks.sqlite"
+# 缓存数据格式版本号，修改缓存中原始数据的格式或精度时需递增，使已缓存的数据全部失效并重新下载
+# （1: 价格以float64保存，此前以float32保存的缓存价格已有舍入误差，不能再复用）
+CACHE_VERSION = 1
+CACHE_COLUMNS = OHLCV_COLUMNS + INDICATOR_COLUMNS
+# 表结构版本保存在数据库的PRAGMA user_version中，由CACHE_VERSION和缓存列计算：
+# 任一变化时删除并重建bars/meta表（0为新建数据库的默认值，不使用）
+_CACHE_SCHEMA_VERSION = (zlib.crc32(f"{CACHE_VERSION}:{','.join(CACHE_COLUMNS)}".encode('utf-8'))
+                         & 0x7fffffff) or 1
+_CACHE_TABLES = [
+    f"""CREATE TABLE bars (
+        symbol TEXT NOT NULL,
+        date TEXT NOT NULL,
+        {", ".join(f"{column} REAL" for column in CACHE_COLUMNS)},
+        PRIMARY KEY (symbol, date)
+    ) WITHOUT ROWID""",
+    """CREATE TABLE meta (
+        symbol TEXT PRIMARY KEY,
+        payload TEXT NOT NULL
+    )"""
+]
+
+# 缓存数据库损坏时只允许一个线程移走并重建
+_cache_rebuild_lock = threading.Lock()
+
+def _rebuild_cache_tables(con):
+    """删除并按当前表结构重建缓存表
+
+    在写事务中再次检查表结构版本，多个线程同时发现版本不一致时只重建一次。
+    """
+    con.execute("BEGIN IMMEDIATE")
+    try:
+        if con.execute("PRAGMA user_version").fetchone()[0] != _CACHE_SCHEMA_VERSION:
+            logger.info("缓存表结构已更新，重建缓存数据库")
+            con.execute("DROP TABLE IF EXISTS bars")
+            con.execute("DROP TABLE IF EXISTS meta")
+            for statement in _CACHE_TABLES:
+                con.execute(statement)
+            con.execute(f"PRAGMA user_version = {_CACHE_SCHEMA_VERSION}")
+        con.commit()
+    except BaseException:
+        con.rollback()
+        raise
+
+def _open_cache(path):
+    """打开缓存数据库，表结构版本不一致（或新建数据库）时重建缓存表；失败时关闭连接后抛出异常"""
+    con = sqlite3.connect(path, timeout=30)
+    try:
+        con.execute("PRAGMA journal_mode=WAL")
+        if con.execute("PRAGMA user_version").fetchone()[0] != _CACHE_SCHEMA_VERSION:
+            _rebuild_cache_tables(con)
+    except BaseException:
+        con.close()
+        raise
+    return con
+
+def _connect_cache(cache_dir):
+    """打开缓存数据库，不存在时创建
+
+    文件已损坏（不是有效的SQLite数据库）时将其移到一旁（加.corrupt后缀）并重新创建，
+    缓存数据随之丢失，但不影响本次获取数据。数据库被锁定等OperationalError照常抛出。
+    """
     os.makedirs(cache_dir, exist_ok=True)
-    cache_file = os.path.join(cache_dir, f"{symbol}_data.pkl")
-    
-    # 检查缓存是否存在且有效
-    if os.path.exists(cache_file):
-        file_time = datetime.fromtimestamp(os.path.getmtime(cache_file))
-        if datetime.now() - file_time < timedelta(hours=cache_expiry_hours):
-            try:
-                with open(cache_file, 'rb') as f:
-                    logger.info(f"使用缓存数据: {symbol}")
-                    return pickle.load(f)
-            except Exception as e:
-                logger.warning(f"读取缓存失败: {str(e)}")
-    
-    # 获取新数据
-    data = get_stock_data(symbol, api_key)
+    path = os.path.join(cache_dir, CACHE_DB_NAME)
+    try:
+        return _open_cache(path)
+    except sqlite3.OperationalError:
+        raise
+    except sqlite3.DatabaseError as e:
+        error = e
     
-    # 保存到缓存
+    # 多只股票并发打开缓存：加锁后先重试，其他线程可能已经重建了数据库
+    with _cache_rebuild_lock:
+        try:
+            return _open_cache(path)
+        except sqlite3.OperationalError:
+            raise
+        except sqlite3.DatabaseError:
+            pass
+        logger.warning(f"缓存数据库已损坏，移至{path}.corrupt并重新创建: {str(error)}")
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.replace(path + suffix, f"{path}.corrupt{suffix}")
+        return _open_cache(path)
+
+def _read_cache_meta(con, symbol):
+    """读取缓存的meta，不存在或读取失败时返回None"""
     try:
-        with open(cache_file, 'wb') as f:
-            pickle.dump(data, f)
+        row = con.execute("SELECT payload FROM meta WHERE symbol = ?", (symbol,)).fetchone()
+        return json.loads(row[0]) if row is not None else None
     except Exception as e:
-        logger.warning(f"保存缓存失败: {str(e)}")
-    
-    return data
+        logger.warning(f"读取缓存失败: {str(e)}")
+        return None
 
-def get_stock_data(symbol, api_key):
-    """使用Alpha Vantage API获取股票的相关数据"""
-    logger.info(f"开始获取{symbol}股票数据...")
-    
-    # 获取股票日线数据
-    url_daily = f"https://www.alphavantage.co/query?function=TIME_SERIES_DAILY&symbol={symbol}&outputsize=full&apikey={api_key}"
-    data_daily = get_api_data(url_daily)
-    
-    # 打印API响应的键，用于调试
-    logger.debug(f"API Response Keys: {data_daily.keys()}")
+def _read_cache_bars(con, symbol, columns=CACHE_COLUMNS, limit=None):
+    """按日期升序读取缓存的日线数据（limit为最近的行数），不存在或读取失败时返回None"""
+    try:
+        df = pd.read_sql_query(
+            f"SELECT * FROM (SELECT date, {', '.join(columns)} FROM bars WHERE symbol = ? "
+            f"ORDER BY date DESC LIMIT ?) ORDER BY date",
+            con,
+            params=(symbol, -1 if limit is None else limit),
+            index_col="date",
+            parse_dates=["date"]
+        )
+    except Exception as e:
+        logger.warning(f"读取缓存失败: {str(e)}")
+        return None
+    if df.empty:
+        return None
+    df.index.name = None
+    # SQLite中的NULL（指标预热期的NaN）整列为空时会被读成object类型，统一转换
+    return df.astype(np.float64)
+
+def _write_cache(con, symbol, df, meta, write_from=0):
+    """在同一事务中写入日线数据和meta
+
+    write_from为df中之前已写入且未变化的行数，只写入之后的行，并删除缓存中这些行起始日期
+    及之后的旧数据（最新数据中可能不再包含某些已缓存的日期）；为0时替换该股票的全部数据。
+    """
+    rows = df.iloc[write_from:]
+    dates = rows.index.strftime("%Y-%m-%d")
+    values = zip(
+        itertools.repeat(symbol),
+        dates,
+        *(rows[column].tolist() for column in CACHE_COLUMNS)
+    )
+    with con:
+        if write_from == 0:
+            con.execute("DELETE FROM bars WHERE symbol = ?", (symbol,))
+        elif len(dates):
+            con.execute("DELETE FROM bars WHERE symbol = ? AND date >= ?", (symbol, dates[0]))
+        con.executemany(
+            f"INSERT OR REPLACE INTO bars (symbol, date, {', '.join(CACHE_COLUMNS)}) "
+            f"VALUES ({', '.join('?' * (len(CACHE_COLUMNS) + 2))})",
+            values
+        )
+        con.execute(
+            "INSERT OR REPLACE INTO meta (symbol, payload) VALUES (?, ?)",
+            (symbol, json.dumps(meta, ensure_ascii=False))
+        )
+
+def get_stock_data_with_cache(symbol, api_key, cache_dir="cache", cache_expiry_hours=4):
+    """获取股票数据及技术指标，支持本地缓存
+
+    所有股票缓存在cache_dir下的同一个SQLite数据库中（见CACHE_DB_NAME）。
+    返回结果中的df只包含最近CHART_DAYS行的RECENT_DF_COLUMNS列。
+
+    缓存按数据更新频率分级失效：最新行情超过cache_expiry_hours后刷新，此时只增量
+    获取最近的日线数据并追加到已缓存的历史数据上；仅当缓存的历史数据与增量数据
+    无法衔接时才重新下载全部历史数据。公司概览（市盈率）每个UTC日只请求一次。
+    """
+    raw_data = None
+    indicator_state = None
+    data_overview = None
+    write_from = 0
+    fetched_at = time.time()
+    overview_date = datetime.now(timezone.utc).date().isoformat()
     
-    # 等待一下，避免API请求过快
-    time.sleep(1)
+    with closing(_connect_cache(cache_dir)) as con:
+        meta = _read_cache_meta(con, symbol)
+        if meta is not None:
+            version_matched = meta.get("indicators_version") == INDICATORS_VERSION
+            # 概览数据中只用到市盈率，当日已获取过时直接复用缓存的结果
+            if meta.get("overview_date") == overview_date:
+                data_overview = {"PERatio": meta["data"]["pe_ratio"]}
+            age = time.time() - meta.get("fetched_at", 0)
+            fresh = age < cache_expiry_hours * 3600
+            if fresh and version_matched:
+                # 指标版本一致时直接返回已计算好的指标，只需读取最近的数据
+                df = _read_cache_bars(con, symbol, RECENT_DF_COLUMNS, CHART_DAYS)
+                if df is not None:
+                    logger.info(f"使用缓存数据: {symbol}")
+                    return dict(meta["data"], df=df)
+            # 指标版本不一致时已缓存的指标失效，只读取原始OHLCV数据
+            history_df = _read_cache_bars(con, symbol, CACHE_COLUMNS if version_matched else OHLCV_COLUMNS)
+            if history_df is None:
+                logger.warning(f"缓存中缺少日线数据，重新获取: {symbol}")
+            elif fresh:
+                logger.info(f"指标版本已更新，使用缓存原始数据重新计算指标: {symbol}")
+                raw_data = dict(meta["data"], df=history_df)
+                fetched_at = meta["fetched_at"]
+                overview_date = meta.get("overview_date")
+            else:
+                # 最新行情已过期，增量获取最近的日线数据，并从缓存的递推状态继续计算新增行的指标
+                updated = update_stock_data(symbol, api_key, history_df, data_overview)
+                if updated is not None:
+                    raw_data, unchanged_rows = updated
+                    if version_matched:
+                        indicator_state = meta.get("indicator_state")
+                        write_from = unchanged_rows
+        
+        # 获取全部历史数据
+        if raw_data is None:
+            raw_data = get_stock_data(symbol, api_key, data_overview)
+            indicator_state = None
+        
+        # 计算技术指标
+        data = process_stock_data(raw_data, indicator_state)
+        indicator_state = data.pop("indicator_state")
+        
+        # 保存到缓存
+        try:
+            meta = {
+                "indicators_version": INDICATORS_VERSION,
+                "fetched_at": fetched_at,
+                "overview_date": overview_date,
+                "indicator_state": indicator_state,
+                "data": {k: v for k, v in data.items() if k != "df"}
+            }
+            _write_cache(con, symbol, data["df"], meta, write_from)
+        except Exception as e:
+            logger.warning(f"保存缓存失败: {str(e)}")
     
-    # 获取公司概览数据（包含市盈率）
-    url_overview = f"https://www.alphavantage.co/query?function=OVERVIEW&symbol={symbol}&apikey={api_key}"
-    data_overview = get_api_data(url_overview)
+    data["df"] = _recent_df(data["df"])
+    return data
+
+def _fetch_daily_and_overview(symbol, api_key, outputsize="full", data_overview=None):
+    """获取股票日线数据和公司概览数据，返回(日线DataFrame, 概览数据)
+
+    outputsize为full时返回全部历史数据，为compact时仅返回最近100个交易日。
+    传入data_overview（当日已获取的概览数据）时不再请求公司概览。
+    """
+    # 股票日线数据和公司概览数据（包含市盈率）相互独立，并发请求
+    # 请求并发数由共享线程池统一控制，无需在两次请求之间等待
+    # 日线数据使用CSV格式：体积比JSON小，且可由pandas的C解析器直接解析为浮点列
+    url_daily = f"https://www.alphavantage.co/query?function=TIME_SERIES_DAILY&symbol={symbol}&outputsize={outputsize}&datatype=csv&apikey={api_key}"
+    future_daily = _api_executor.submit(get_api_data, url_daily)
+    if data_overview is None:
+        url_overview = f"https://www.alphavantage.co/query?function=OVERVIEW&symbol={symbol}&apikey={api_key}"
+        data_overview = _api_executor.submit(get_api_data, url_overview).result()
+    data_daily = future_daily.result()
     
     # 打印概览数据的键，用于调试
     logger.debug(f"Overview Response Keys: {data_overview.keys()}")
     
-    # 将日线数据转换为DataFrame
-    time_series = data_daily.get("Time Series (Daily)", {})
-    if not time_series:
+    # 接口出错时返回JSON格式的错误说明而不是CSV
+    if not isinstance(data_daily, bytes):
         logger.error("Error: No time series data returned from API")
         logger.error(f"Full API response: {data_daily}")
         raise ValueError(f"Failed to get time series data from Alpha Vantage for {symbol}")
-        
-    df = pd.DataFrame(time_series).T
-    df.index = pd.to_datetime(df.index)
-    df = df.sort_index()
     
-    # 将字符串转换为浮点数
-    for col in df.columns:
-        df[col] = pd.to_numeric(df[col])
+    # CSV列为timestamp,open,high,low,close,volume，按日期降序排列
+    df = pd.read_csv(io.BytesIO(data_daily), index_col=0, parse_dates=True, dtype=np.float64)
+    if df.empty or list(df.columns) != OHLCV_COLUMNS:
+        logger.error(f"Unexpected CSV response: {data_daily[:200]!r}")
+        raise ValueError(f"Failed to get time series data from Alpha Vantage for {symbol}")
+    df.index.name = None
+    if not df.index.is_monotonic_increasing:
+        df = df.iloc[::-1] if df.index.is_monotonic_decreasing else df.sort_index()
     
-    # 重命名列
-    df.columns = ['open', 'high', 'low', 'close', 'volume']
+    return df, data_overview
+
+def get_stock_data(symbol, api_key, data_overview=None):
+    """使用Alpha Vantage API获取股票的相关数据（data_overview含义同_fetch_daily_and_overview）"""
+    logger.info(f"开始获取{symbol}股票数据...")
+    df, data_overview = _fetch_daily_and_overview(symbol, api_key, data_overview=data_overview)
+    return build_stock_data(df, data_overview)
+
+def update_stock_data(symbol, api_key, history_df, data_overview=None):
+    """增量更新股票数据：只获取最近的日线数据并追加到已有的历史数据
+
+    返回(股票数据, 未变化的行数)，后者为结果df开头与history_df完全相同的行数；
+    最近的数据与history_df之间存在缺口（无法衔接）时返回None；data_overview含义同
+    _fetch_daily_and_overview。history_df中重叠日期的数据均未变化时保留其全部行（包括已计算的指标列），
+    只追加新的日期；否则用最新数据覆盖重叠的日期，并丢弃指标列以便重新计算。
+    """
+    logger.info(f"开始增量获取{symbol}股票数据...")
+    recent_df, data_overview = _fetch_daily_and_overview(symbol, api_key, outputsize="compact",
+                                                         data_overview=data_overview)
+    
+    if history_df.empty or recent_df.index[0] > history_df.index[-1]:
+        logger.info(f"缓存的历史数据无法与最新数据衔接，重新获取全部历史数据: {symbol}")
+        return None
     
+    keep = history_df.index.searchsorted(recent_df.index[0])
+    overlap = len(history_df) - keep
+    history_tail = history_df.iloc[keep:]
+    if (recent_df.index[:overlap].equals(history_tail.index)
+            and np.array_equal(recent_df.to_numpy()[:overlap],
+                               history_tail[OHLCV_COLUMNS].to_numpy())):
+        df = pd.concat([history_df, recent_df.iloc[overlap:]])
+        unchanged_rows = len(history_df)
+    else:
+        # 重叠日期的数据有变化（当日数据可能在收盘前被缓存），用最新数据覆盖
+        history_head = history_df.iloc[:keep]
+        history_head = history_head.drop(columns=history_head.columns.difference(OHLCV_COLUMNS))
+        df = pd.concat([history_head, recent_df])
+        unchanged_rows = keep
+    return build_stock_data(df, data_overview), unchanged_rows
+
+def build_stock_data(df, data_overview):
+    """根据按日期排序的日线数据和公司概览数据计算股票的当前数据"""
     # 获取当前数据
     latest_date = df.index[-1]
-    current_price = df.loc[latest_date, 'close']
+    current_price = df.iat[-1, df.columns.get_loc('close')]
     
     # 计算52周最高价和最低价
     one_year_ago = latest_date - timedelta(days=365)
-    df_52_weeks = df[df.index >= one_year_ago]
-    high_52_week = df_52_weeks['high'].max()
-    low_52_week = df_52_weeks['low'].min()
+    # df已按日期排序，二分查找起始位置后按位置切片，无需构建布尔掩码
+    start = df.index.searchsorted(one_year_ago)
+    df_52_weeks = df.iloc[start:]
+    high_52_week = df['high'].to_numpy()[start:].max()
+    low_52_week = df['low'].to_numpy()[start:].min()
     
     # 获取市盈率
     pe_ratio = float(data_overview.get("PERatio", 0))
@@ -143,12 +425,12 @@ def get_stock_data(symbol, api_key):
     # 检测52周内是否有价格异常变动
     price_anomaly = detect_price_anomalies(df_52_weeks)
     
-    # 返回原始DataFrame，后续会在indicators模块中添加技术指标
+    # 返回原始DataFrame，技术指标由indicators模块添加
     return {
         "date": latest_date.strftime("%Y-%m-%d"),
-        "current_price": round(current_price, 2),
-        "high_52_week": round(high_52_week, 2),
-        "low_52_week": round(low_52_week, 2),
+        "current_price": round(float(current_price), 2),
+        "high_52_week": round(float(high_52_week), 2),
+        "low_52_week": round(float(low_52_week), 2),
         "pe_ratio": round(pe_ratio, 2),
         "price_anomaly": price_anomaly,
         "df": df
@@ -1,63 +1,359 @@
-"""技术指标计算模块"""
+"""技术指标计算模块
+
+所有calculate_*函数直接在传入的DataFrame上添加指标列，并返回同一个对象。
+"""
 
 import pandas as pd
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from stock_analysis._njit import NUMBA_AVAILABLE, njit
+
+# 指标计算公式版本号，修改任何指标公式时需递增，使已缓存的指标结果失效
+INDICATORS_VERSION = 2
+
+@njit(cache=True)
+def _rolling_mean_njit(x, window):
+    """滑动窗口均值（单次遍历，维护窗口内累计和）"""
+    n = x.shape[0]
+    out = np.full(n, np.nan)
+    total = 0.0
+    for i in range(n):
+        total += x[i]
+        if i >= window:
+            total -= x[i - window]
+        if i >= window - 1:
+            out[i] = total / window
+    return out
+
+@njit(cache=True)
+def _rolling_mean_std_njit(x, window):
+    """滑动窗口均值和样本标准差，单次遍历同时维护累计和与平方和
+
+    累计前先减去首个元素，降低平方和相减时的精度损失。
+    """
+    n = x.shape[0]
+    mean = np.full(n, np.nan)
+    std = np.full(n, np.nan)
+    if n == 0:
+        return mean, std
+    shift = x[0]
+    total = 0.0
+    total_sq = 0.0
+    for i in range(n):
+        d = x[i] - shift
+        total += d
+        total_sq += d * d
+        if i >= window:
+            old = x[i - window] - shift
+            total -= old
+            total_sq -= old * old
+        if i >= window - 1:
+            m = total / window
+            var = (total_sq - total * m) / (window - 1)
+            mean[i] = m + shift
+            std[i] = np.sqrt(var) if var > 0.0 else 0.0
+    return mean, std
+
+@njit(cache=True)
+def _ema_njit(x, span):
+    """指数移动平均，等价于 ewm(span=span, adjust=False).mean()"""
+    n = x.shape[0]
+    out = np.empty(n)
+    if n == 0:
+        return out
+    alpha = 2.0 / (span + 1.0)
+    out[0] = x[0]
+    for i in range(1, n):
+        out[i] = alpha * x[i] + (1.0 - alpha) * out[i - 1]
+    return out
+
+@njit(cache=True)
+def _rsi_from_averages(avg_gain, avg_loss):
+    """由平均涨幅和平均跌幅计算RSI值"""
+    if avg_loss > 0.0:
+        return 100.0 - 100.0 / (1.0 + avg_gain / avg_loss)
+    if avg_gain > 0.0:
+        return 100.0
+    return np.nan
+
+@njit(cache=True)
+def _rsi_njit(close, window):
+    """单次遍历计算RSI（Wilder平滑）
+
+    首个平均涨跌幅为前window个涨跌幅的简单平均，
+    之后按 avg = (prev * (window - 1) + cur) / window 递推。
+    """
+    n = close.shape[0]
+    out = np.full(n, np.nan)
+    avg_gain = 0.0
+    avg_loss = 0.0
+    for i in range(1, n):
+        delta = close[i] - close[i - 1]
+        gain = delta if delta > 0 else 0.0
+        loss = -delta if delta < 0 else 0.0
+        if i <= window:
+            avg_gain += gain
+            avg_loss += loss
+            if i == window:
+                avg_gain /= window
+                avg_loss /= window
+        else:
+            avg_gain = (avg_gain * (window - 1) + gain) / window
+            avg_loss = (avg_loss * (window - 1) + loss) / window
+        if i >= window:
+            out[i] = _rsi_from_averages(avg_gain, avg_loss)
+    return out
+
+# 融合内核使用的固定指标参数。numba将全局变量视为编译期常量，
+# 窗口长度不作为参数传入，便于编译器常量折叠
+W14, W20, W50, W200 = 14, 20, 50, 200
+EMA_FAST, EMA_SLOW, EMA_SIGNAL = 12, 26, 9
+BOLLINGER_STD = 2
+
+# 允许乘加融合、倒数近似等不改变运算顺序的优化；不启用nnan/ninf（指标数组含NaN）
+# 和reassoc（保证增量计算与全量计算的累计和按相同顺序求值）
+_KERNEL_FASTMATH = {'nsz', 'arcp', 'contract', 'afn'}
+
+@njit(cache=True, fastmath=_KERNEL_FASTMATH)
+def _extend_all_indicators_njit(close, start, state):
+    """从第start行开始单次遍历收盘价，同时计算全部技术指标
+
+    MA50/MA200/MA20使用环形缓冲区维护窗口累计和，布林带标准差使用
+    （减去首个收盘价后的）累计平方和，RSI的Wilder平均涨跌幅和MACD的
+    三条EMA按递推式逐点更新。
+
+    state为计算到第start-1行后的递推状态[ema12, ema26, ema9, avg_gain, avg_loss]，
+    start为0时忽略；窗口类指标所需的历史收盘价直接从close中回填，因此close可以是
+    完整序列的尾部切片，只需包含第start行之前的W200行。
+    返回第start行及之后的各指标数组，以及计算到最后一行后的递推状态。
+    """
+    n = close.shape[0]
+    m = n - start
+    ma50 = np.full(m, np.nan)
+    ma200 = np.full(m, np.nan)
+    rsi = np.full(m, np.nan)
+    macd = np.empty(m)
+    signal = np.empty(m)
+    macd_hist = np.empty(m)
+    ma20 = np.full(m, np.nan)
+    upper_band = np.full(m, np.nan)
+    lower_band = np.full(m, np.nan)
+
+    buf50 = np.zeros(W50)
+    buf200 = np.zeros(W200)
+    buf20 = np.zeros(W20)
+    sum50 = 0.0
+    sum200 = 0.0
+    sum20 = 0.0
+    sumsq20 = 0.0
+    shift = close[0] if n > 0 else 0.0
+
+    # 回填窗口内已有的收盘价
+    for i in range(max(0, start - W200), start):
+        x = close[i]
+        buf200[i % W200] = x
+        sum200 += x
+        if i >= start - W50:
+            buf50[i % W50] = x
+            sum50 += x
+        if i >= start - W20:
+            d = x - shift
+            buf20[i % W20] = d
+            sum20 += d
+            sumsq20 += d * d
+
+    alpha12 = 2.0 / (EMA_FAST + 1)
+    alpha26 = 2.0 / (EMA_SLOW + 1)
+    alpha9 = 2.0 / (EMA_SIGNAL + 1)
+    ema12 = state[0]
+    ema26 = state[1]
+    ema9 = state[2]
+    avg_gain = state[3] if start > 0 else 0.0
+    avg_loss = state[4] if start > 0 else 0.0
+
+    for i in range(start, n):
+        x = close[i]
+        j = i - start
+
+        # 移动平均线
+        k = i % W50
+        sum50 += x - buf50[k]
+        buf50[k] = x
+        if i >= W50 - 1:
+            ma50[j] = sum50 / W50
+
+        k = i % W200
+        sum200 += x - buf200[k]
+        buf200[k] = x
+        if i >= W200 - 1:
+            ma200[j] = sum200 / W200
+
+        # 布林带
+        k = i % W20
+        d = x - shift
+        old = buf20[k]
+        sum20 += d - old
+        sumsq20 += d * d - old * old
+        buf20[k] = d
+        if i >= W20 - 1:
+            mean = sum20 / W20
+            var = (sumsq20 - sum20 * mean) / (W20 - 1)
+            sd = np.sqrt(var) if var > 0.0 else 0.0
+            mean += shift
+            ma20[j] = mean
+            upper_band[j] = mean + sd * BOLLINGER_STD
+            lower_band[j] = mean - sd * BOLLINGER_STD
+
+        # RSI
+        if i > 0:
+            delta = x - close[i - 1]
+            gain = delta if delta > 0 else 0.0
+            loss = -delta if delta < 0 else 0.0
+            if i <= W14:
+                avg_gain += gain
+                avg_loss += loss
+                if i == W14:
+                    avg_gain /= W14
+                    avg_loss /= W14
+            else:
+                avg_gain = (avg_gain * (W14 - 1) + gain) / W14
+                avg_loss = (avg_loss * (W14 - 1) + loss) / W14
+            if i >= W14:
+                rsi[j] = _rsi_from_averages(avg_gain, avg_loss)
+
+        # MACD
+        if i == 0:
+            ema12 = x
+            ema26 = x
+        else:
+            ema12 = alpha12 * x + (1.0 - alpha12) * ema12
+            ema26 = alpha26 * x + (1.0 - alpha26) * ema26
+        diff = ema12 - ema26
+        if i == 0:
+            ema9 = diff
+        else:
+            ema9 = alpha9 * diff + (1.0 - alpha9) * ema9
+        macd[j] = diff
+        signal[j] = ema9
+        macd_hist[j] = diff - ema9
+
+    new_state = np.array([ema12, ema26, ema9, avg_gain, avg_loss])
+    return (ma50, ma200, rsi, macd, signal, macd_hist,
+            ma20, upper_band, lower_band), new_state
+
+def _rolling_mean(x, window):
+    """滑动窗口均值：numba可用时使用JIT内核，否则使用numpy滑动窗口视图向量化计算"""
+    if NUMBA_AVAILABLE or x.shape[0] < window:
+        return _rolling_mean_njit(x, window)
+    out = np.full(x.shape[0], np.nan)
+    out[window - 1:] = sliding_window_view(x, window).mean(axis=-1)
+    return out
+
+def _rolling_mean_std(x, window):
+    """滑动窗口均值和样本标准差，分派方式同_rolling_mean"""
+    if NUMBA_AVAILABLE or x.shape[0] < window:
+        return _rolling_mean_std_njit(x, window)
+    mean = np.full(x.shape[0], np.nan)
+    std = np.full(x.shape[0], np.nan)
+    windows = sliding_window_view(x, window)
+    mean[window - 1:] = windows.mean(axis=-1)
+    std[window - 1:] = windows.std(axis=-1, ddof=1)
+    return mean, std
 
 def calculate_moving_averages(df, windows=[50, 200]):
     """计算移动平均线"""
-    result = df.copy()
+    close = df['close'].to_numpy(dtype=np.float64)
     for window in windows:
-        result[f'ma{window}'] = result['close'].rolling(window=window).mean()
-    return result
+        df[f'ma{window}'] = _rolling_mean(close, window)
+    return df
 
 def calculate_rsi(df, window=14):
-    """计算相对强弱指数(RSI)"""
-    delta = df['close'].diff()
-    gain = delta.where(delta > 0, 0)
-    loss = -delta.where(delta < 0, 0)
-    
-    avg_gain = gain.rolling(window=window).mean()
-    avg_loss = loss.rolling(window=window).mean()
-    
-    rs = avg_gain / avg_loss
-    df['rsi'] = 100 - (100 / (1 + rs))
+    """计算相对强弱指数(RSI)，采用Wilder平滑"""
+    close = df['close'].to_numpy(dtype=np.float64)
+    df['rsi'] = _rsi_njit(close, window)
     return df
 
 def calculate_macd(df, fast=12, slow=26, signal=9):
     """计算MACD指标"""
-    exp_fast = df['close'].ewm(span=fast, adjust=False).mean()
-    exp_slow = df['close'].ewm(span=slow, adjust=False).mean()
-    df['macd'] = exp_fast - exp_slow
-    df['signal'] = df['macd'].ewm(span=signal, adjust=False).mean()
-    df['macd_hist'] = df['macd'] - df['signal']
+    close = df['close'].to_numpy(dtype=np.float64)
+    macd = _ema_njit(close, fast) - _ema_njit(close, slow)
+    signal_line = _ema_njit(macd, signal)
+    df['macd'] = macd
+    df['signal'] = signal_line
+    df['macd_hist'] = macd - signal_line
     return df
 
 def calculate_bollinger_bands(df, window=20, num_std=2):
     """计算布林带"""
-    df['ma20'] = df['close'].rolling(window=window).mean()
-    std20 = df['close'].rolling(window=window).std()
-    df['upper_band'] = df['ma20'] + (std20 * num_std)
-    df['lower_band'] = df['ma20'] - (std20 * num_std)
+    close = df['close'].to_numpy(dtype=np.float64)
+    ma, std = _rolling_mean_std(close, window)
+    df['ma20'] = ma
+    df['upper_band'] = ma + (std * num_std)
+    df['lower_band'] = ma - (std * num_std)
     return df
 
+# calculate_all_indicators写入的指标列，顺序与_extend_all_indicators_njit的返回值一致
+INDICATOR_COLUMNS = ['ma50', 'ma200', 'rsi', 'macd', 'signal', 'macd_hist',
+                     'ma20', 'upper_band', 'lower_band']
+
+# 增量计算所需的递推状态字段，顺序与_extend_all_indicators_njit的state参数一致
+INDICATOR_STATE_FIELDS = ['ema12', 'ema26', 'ema9', 'avg_gain', 'avg_loss']
+
+def update_all_indicators(df, state=None):
+    """计算所有技术指标，返回可用于下次增量计算的递推状态
+
+    state为上次计算返回的状态，其中rows为已计算指标的行数：传入时df的前rows行
+    须保留原有的指标列，只计算之后新增的行；否则重新计算全部行。
+    numba不可用且需要全量计算时使用向量化实现，返回None（下次仍全量计算）。
+    """
+    start = 0
+    if (state is not None and 0 < state.get("rows", 0) <= len(df)
+            and all(column in df.columns for column in INDICATOR_COLUMNS)):
+        start = state["rows"]
+        
+    if start == 0:
+        if not NUMBA_AVAILABLE:
+            # 纯Python逐点循环较慢，改用各指标的numpy向量化实现
+            calculate_moving_averages(df)
+            calculate_rsi(df)
+            calculate_macd(df)
+            calculate_bollinger_bands(df)
+            return None
+        close = df['close'].to_numpy(dtype=np.float64)
+        values, new_state = _extend_all_indicators_njit(close, 0, np.zeros(len(INDICATOR_STATE_FIELDS)))
+        for column, value in zip(INDICATOR_COLUMNS, values):
+            df[column] = value
+    else:
+        prev_state = np.array([state[field] for field in INDICATOR_STATE_FIELDS], dtype=np.float64)
+        # 窗口类指标最多回看W200行，只需转换和遍历最近的收盘价，无需扫描全部历史
+        offset = max(0, start - W200)
+        close = df['close'].to_numpy()[offset:].astype(np.float64)
+        values, new_state = _extend_all_indicators_njit(close, start - offset, prev_state)
+        for column, value in zip(INDICATOR_COLUMNS, values):
+            df.iloc[start:, df.columns.get_loc(column)] = value
+    
+    result = dict(zip(INDICATOR_STATE_FIELDS, new_state.tolist()))
+    result["rows"] = len(df)
+    return result
+
 def calculate_all_indicators(df):
-    """计算所有技术指标"""
-    df = calculate_moving_averages(df)
-    df = calculate_rsi(df)
-    df = calculate_macd(df)
-    df = calculate_bollinger_bands(df)
+    """计算所有技术指标（numba可用时单次遍历收盘价）"""
+    update_all_indicators(df)
     return df
 
-def process_stock_data(stock_data):
-    """处理股票数据，添加技术指标"""
-    df = stock_data["df"].copy()
-    df = calculate_all_indicators(df)
+def process_stock_data(stock_data, indicator_state=None):
+    """处理股票数据，添加技术指标
+
+    技术指标直接写入stock_data["df"]（不复制DataFrame），返回的结果与之共享同一个df。
+    传入indicator_state时只计算新增行的指标（见update_all_indicators），
+    计算后的递推状态保存在结果的indicator_state字段中。
+    """
+    df = stock_data["df"]
+    state = update_all_indicators(df, indicator_state)
     
-    # 获取最新数据点的指标值
-    latest_date = df.index[-1]
-    ma50 = df.loc[latest_date, 'ma50']
-    ma200 = df.loc[latest_date, 'ma200']
-    rsi = df.loc[latest_date, 'rsi']
+    # 按位置读取最新数据点的指标值，无需经过日期索引查找
+    ma50, ma200, rsi = (df.iat[-1, df.columns.get_loc(column)] for column in ('ma50', 'ma200', 'rsi'))
     
     # 更新股票数据
     result = stock_data.copy()
@@ -65,5 +361,6 @@ def process_stock_data(stock_data):
     result["ma50"] = round(ma50, 2)
     result["ma200"] = round(ma200, 2)
     result["rsi"] = round(rsi, 2)
+    result["indicator_state"] = state
     
     return result
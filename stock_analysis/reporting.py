@@ -1,39 +1,210 @@
 """报告模块"""
 
 import os
+import time
+import hashlib
 import logging
 import smtplib
+import threading
+from email.mime.image import MIMEImage
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from datetime import datetime
 
-from stock_analysis.visualization import create_price_chart
+import jinja2
+
+from stock_analysis.constants import CHART_DAYS, RECENT_DF_COLUMNS
 
 logger = logging.getLogger(__name__)
 
-def send_email_report(stock_data, analysis_data, email_config, symbol_name):
-    """发送分析报告到指定邮箱"""
-    # 从环境变量或配置获取邮箱配置
-    sender_email = email_config.get("from") or os.environ.get("EMAIL_FROM")
-    sender_password = email_config.get("password") or os.environ.get("EMAIL_PASSWORD")
-    receiver_email = email_config.get("to") or os.environ.get("EMAIL_TO")
+# 邮件HTML模板在模块加载时编译一次，之后每次发送只需渲染
+_TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates")
+_TEMPLATE_ENV = jinja2.Environment(
+    loader=jinja2.FileSystemLoader(_TEMPLATE_DIR),
+    autoescape=jinja2.select_autoescape(["html"])
+)
+_REPORT_TEMPLATE = _TEMPLATE_ENV.get_template("report.html")
+_ERROR_TEMPLATE = _TEMPLATE_ENV.get_template("error.html")
+
+# 股价图表作为内嵌图片随邮件发送，HTML中通过cid:引用
+CHART_CID = "price_chart"
+
+# 已生成的股价图表按图表数据缓存为PNG文件，同一天重复运行时无需重新绘制（也无需导入matplotlib）
+CHART_CACHE_DIR = os.path.join("cache", "charts")
+CHART_CACHE_DAYS = 7  # 超过该天数的图表缓存文件在写入新图表时删除
+# 图表样式版本号，修改create_price_chart的绘制方式时需递增，使已缓存的图表失效
+CHART_VERSION = 1
+
+# 发件邮箱域名对应的SMTP服务器，未列出的域名使用DEFAULT_SMTP_HOST
+# 端口为SMTP_SSL_PORT时直接建立SSL连接，省去STARTTLS升级的往返；其余端口使用STARTTLS
+SMTP_HOSTS = {
+    "gmail.com": ("smtp.gmail.com", 465),
+    "outlook.com": ("smtp.office365.com", 587),  # Office 365不支持465端口
+    "hotmail.com": ("smtp.office365.com", 587),
+    "yahoo.com": ("smtp.mail.yahoo.com", 465),
+}
+# 默认使用Gmail，也可以在邮件配置中通过smtp_host/smtp_port指定
+DEFAULT_SMTP_HOST = ("smtp.gmail.com", 465)
+SMTP_SSL_PORT = 465
+SMTP_TIMEOUT = 20  # 秒
+
+class SmtpReporter:
+    """邮件发送器，多封邮件复用同一个已登录的SMTP连接
+
+    连接在首次发送时建立，断开后自动重连；可作为上下文管理器使用，
+    退出时关闭连接。发送操作加锁，可在多个线程之间共享。
+    """
     
-    if not sender_email or not sender_password or not receiver_email:
-        logger.error("邮箱配置缺失，无法发送邮件")
-        return {"status": "error", "message": "邮箱配置缺失"}
+    def __init__(self, email_config):
+        # 从环境变量或配置获取邮箱配置
+        self.sender_email = email_config.get("from") or os.environ.get("EMAIL_FROM")
+        self.sender_password = email_config.get("password") or os.environ.get("EMAIL_PASSWORD")
+        self.receiver_email = email_config.get("to") or os.environ.get("EMAIL_TO")
+        self.smtp_host = email_config.get("smtp_host")
+        self.smtp_port = email_config.get("smtp_port")
+        self._server = None
+        self._lock = threading.Lock()
     
-    # 打印邮箱配置（不包含密码）
-    logger.info(f"准备发送邮件从 {sender_email} 到 {receiver_email}")
+    @property
+    def configured(self):
+        """邮箱配置是否完整"""
+        return bool(self.sender_email and self.sender_password and self.receiver_email)
     
-    # 创建今天的日期字符串
-    today = datetime.now().strftime("%Y-%m-%d")
+    def _connect(self):
+        """连接SMTP服务器并登录"""
+        domain = self.sender_email.rsplit("@", 1)[-1].lower()
+        host, port = SMTP_HOSTS.get(domain, DEFAULT_SMTP_HOST)
+        host = self.smtp_host or host
+        port = int(self.smtp_port or port)
+        if port == SMTP_SSL_PORT:
+            server = smtplib.SMTP_SSL(host, port, timeout=SMTP_TIMEOUT)
+        else:
+            server = smtplib.SMTP(host, port, timeout=SMTP_TIMEOUT)
+            server.starttls()  # 启用安全传输
+        server.login(self.sender_email, self.sender_password)
+        self._server = server
+    
+    def connect(self):
+        """提前连接并登录SMTP服务器（已连接时忽略）
+
+        用于在获取数据、生成图表的同时完成SMTP握手；失败时只记录日志，
+        发送时会重新尝试连接。
+        """
+        with self._lock:
+            if self._server is not None:
+                return
+            try:
+                self._connect()
+            except Exception as e:
+                logger.warning(f"预先连接SMTP服务器失败: {str(e)}")
+    
+    def send(self, msg):
+        """发送邮件，连接断开时重连一次后重试"""
+        # 直接序列化为字节，避免as_string()生成str后sendmail再编码一次
+        data = msg.as_bytes()
+        with self._lock:
+            if self._server is None:
+                self._connect()
+            try:
+                self._server.sendmail(self.sender_email, self.receiver_email, data)
+            except smtplib.SMTPServerDisconnected:
+                logger.warning("SMTP连接已断开，正在重新连接")
+                self._connect()
+                self._server.sendmail(self.sender_email, self.receiver_email, data)
+    
+    def close(self):
+        """关闭SMTP连接"""
+        with self._lock:
+            if self._server is not None:
+                try:
+                    self._server.quit()
+                except smtplib.SMTPException:
+                    pass
+                self._server = None
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def _send(reporter, subject, html, images=None):
+    """构建HTML邮件并通过reporter发送，发送失败时抛出异常
+
+    images为{Content-ID: PNG图像数据}，作为内嵌图片附加在HTML之后（multipart/related）。
+    """
+    msg = MIMEMultipart('related') if images else MIMEMultipart()
+    msg['From'] = reporter.sender_email
+    msg['To'] = reporter.receiver_email
+    msg['Subject'] = subject
+    msg.attach(MIMEText(html, 'html'))
+    for cid, image_png in (images or {}).items():
+        image = MIMEImage(image_png, 'png')
+        image.add_header('Content-ID', f'<{cid}>')
+        image.add_header('Content-Disposition', 'inline', filename=f'{cid}.png')
+        msg.attach(image)
+    reporter.send(msg)
+
+def _chart_cache_key(df, symbol_name, days=CHART_DAYS):
+    """根据图表用到的数据计算缓存键"""
+    recent_data = df.iloc[-days:]
+    digest = hashlib.sha1(f"{CHART_VERSION}:{symbol_name}:{days}".encode('utf-8'))
+    digest.update(recent_data.index.asi8.tobytes())
+    for column in RECENT_DF_COLUMNS:
+        if column in recent_data.columns:
+            digest.update(column.encode('utf-8'))
+            digest.update(recent_data[column].to_numpy().tobytes())
+    return digest.hexdigest()
+
+def _prune_chart_cache():
+    """删除过期的图表缓存文件"""
+    expire_before = time.time() - CHART_CACHE_DAYS * 86400
+    with os.scandir(CHART_CACHE_DIR) as entries:
+        for entry in entries:
+            if not entry.name.endswith(".png"):
+                continue
+            # 多个线程可能同时清理，文件已被其他线程删除时跳过
+            try:
+                if entry.stat().st_mtime < expire_before:
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+def get_price_chart(df, symbol_name, days=CHART_DAYS):
+    """获取过去days天的股价图表PNG数据，图表数据未变化时直接读取缓存"""
+    path = os.path.join(CHART_CACHE_DIR, f"{_chart_cache_key(df, symbol_name, days)}.png")
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except OSError:
+        pass
+    
+    # 延迟导入：matplotlib导入耗时较长，仅在需要绘制图表时才导入
+    from stock_analysis.visualization import create_price_chart
+    chart_png = create_price_chart(df, symbol_name, days)
     
-    # 创建邮件对象
-    msg = MIMEMultipart()
-    msg['From'] = sender_email
-    msg['To'] = receiver_email
-    msg['Subject'] = f"{symbol_name}股票分析 - {today}"
+    # 先写入临时文件再重命名，避免并发运行时读到不完整的文件
+    try:
+        os.makedirs(CHART_CACHE_DIR, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(chart_png)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning(f"保存图表缓存失败: {str(e)}")
+        return chart_png
     
+    try:
+        _prune_chart_cache()
+    except OSError as e:
+        logger.warning(f"清理过期图表缓存失败: {str(e)}")
+    return chart_png
+
+def render_report(stock_data, analysis_data, symbol_name):
+    """生成分析报告邮件的内容，返回(HTML, 股价图表PNG数据)
+
+    HTML通过cid:CHART_CID引用图表。
+    """
     # 设置信号颜色和状态表情
     if analysis_data["recommendation"] == "可以考虑买入":
         signal_color = "green"
@@ -45,175 +216,68 @@ def send_email_report(stock_data, analysis_data, email_config, symbol_name):
         signal_color = "red"
         emoji = "🔴"
     
-    # 格式化买入信号显示
-    buy_signals_html = ""
-    if analysis_data["buy_signals"]:
-        buy_signals_html = "<ul style='margin: 5px 0;'>"
-        for signal in analysis_data["buy_signals"]:
-            buy_signals_html += f"<li>{signal}</li>"
-        buy_signals_html += "</ul>"
-    else:
-        buy_signals_html = "无买入信号"
-    
-    # 创建价格异常提示（如有）
-    anomaly_note = ""
-    if stock_data.get("price_anomaly", {}).get("detected", False):
-        anomaly = stock_data["price_anomaly"]
-        # 根据价格变动方向提供不同提示
-        if anomaly["change_pct"] < 0:
-            anomaly_note = f""" <span style="font-size:11px;color:#666;">(注意: 在{anomaly["date"]}检测到价格下跌{abs(anomaly["change_pct"])}%，可能是股票拆分)</span>"""
-        else:
-            anomaly_note = f""" <span style="font-size:11px;color:#666;">(注意: 在{anomaly["date"]}检测到价格上涨{anomaly["change_pct"]}%，可能是股票合并或其他重大事件)</span>"""
-    
-    # 创建过去30天的股价折线图
-    price_chart_base64 = create_price_chart(stock_data["df"], symbol_name)
-    
-    # 创建HTML邮件内容
-    html = f"""
-    <html>
-    <head>
-        <style>
-            body {{ font-family: Arial, sans-serif; margin: 0; padding: 20px; color: #333; }}
-            table {{ border-collapse: collapse; width: 100%; margin-bottom: 20px; }}
-            th, td {{ border: 1px solid #ddd; padding: 10px; text-align: left; }}
-            th {{ background-color: #f2f2f2; font-weight: bold; }}
-            .recommendation {{ 
-                font-weight: bold; 
-                color: {signal_color}; 
-                font-size: 18px; 
-                padding: 15px;
-                background-color: #f9f9f9;
-                border-radius: 5px;
-                display: inline-block;
-                margin-top: 15px;
-            }}
-            h3 {{ 
-                color: #333; 
-                border-bottom: 1px solid #ddd; 
-                padding-bottom: 8px;
-                margin-top: 25px;
-            }}
-            .data-section {{ margin-bottom: 25px; }}
-            ul {{ padding-left: 20px; }}
-            li {{ margin-bottom: 5px; }}
-            .chart-container {{
-                margin: 20px 0;
-                padding: 10px;
-                background-color: #f9f9f9;
-                border-radius: 5px;
-                text-align: center;
-            }}
-        </style>
-    </head>
-    <body>
-        <div class="data-section">
-            <h3>当前数据</h3>
-            <table>
-                <tr><th>指标</th><th>数值</th></tr>
-                <tr><td>当前股价</td><td>${stock_data["current_price"]}</td></tr>
-                <tr><td>52周最高价</td><td>${stock_data["high_52_week"]}{anomaly_note}</td></tr>
-                <tr><td>52周最低价</td><td>${stock_data["low_52_week"]}</td></tr>
-                <tr><td>200日均线</td><td>${stock_data["ma200"]}</td></tr>
-                <tr><td>50日均线</td><td>${stock_data["ma50"]}</td></tr>
-                <tr><td>RSI值 (14日)</td><td>{stock_data["rsi"]}</td></tr>
-                <tr><td>市盈率(TTM)</td><td>{stock_data["pe_ratio"]}</td></tr>
-            </table>
-            
-            <!-- 添加过去30天的股价图表 -->
-            <div class="chart-container">
-                <img src="data:image/png;base64,{price_chart_base64}" alt="{symbol_name}股票过去30天价格走势" style="max-width:100%;">
-            </div>
-        </div>
-        
-        <div class="data-section">
-            <h3>买入策略分析</h3>
-            <table>
-                <tr><th>指标</th><th>数值</th></tr>
-                <tr><td>买入信号</td><td>{buy_signals_html}</td></tr>
-                <tr><td>信号数量</td><td>{analysis_data["signals_count"]}</td></tr>
-                <tr><td>市场位置</td><td>{analysis_data["market_position"]}</td></tr>
-                <tr><td>价格位置</td><td>{analysis_data["price_position_percentage"]}%</td></tr>
-            </table>
-            
-            <div style="margin-top: 20px; text-align: center;">
-                <p class="recommendation">{emoji} 买入建议: {analysis_data["recommendation"]}</p>
-            </div>
-        </div>
-    </body>
-    </html>
+    # 创建过去CHART_DAYS天的股价折线图
+    chart_png = get_price_chart(stock_data["df"], symbol_name)
+    
+    # 渲染HTML邮件内容（买入信号列表和价格异常提示由模板处理）
+    html = _REPORT_TEMPLATE.render(
+        stock_data=stock_data,
+        analysis_data=analysis_data,
+        anomaly=stock_data.get("price_anomaly"),
+        signal_color=signal_color,
+        emoji=emoji,
+        symbol_name=symbol_name,
+        chart_cid=CHART_CID,
+        chart_days=CHART_DAYS
+    )
+    return html, chart_png
+
+def send_email_report(stock_data, analysis_data, email_config, symbol_name, reporter=None):
+    """发送分析报告到指定邮箱
+
+    传入reporter时复用其SMTP连接，否则为本次发送单独建立连接。
     """
+    if reporter is None:
+        with SmtpReporter(email_config) as reporter:
+            return send_email_report(stock_data, analysis_data, email_config, symbol_name, reporter)
     
-    # 添加HTML内容到邮件
-    msg.attach(MIMEText(html, 'html'))
+    sender_email = reporter.sender_email
+    receiver_email = reporter.receiver_email
+    
+    if not reporter.configured:
+        logger.error("邮箱配置缺失，无法发送邮件")
+        return {"status": "error", "message": "邮箱配置缺失"}
+    
+    # 打印邮箱配置（不包含密码）
+    logger.info(f"准备发送邮件从 {sender_email} 到 {receiver_email}")
+    
+    # 创建今天的日期字符串
+    today = datetime.now().strftime("%Y-%m-%d")
+    
+    html, chart_png = render_report(stock_data, analysis_data, symbol_name)
     
     try:
-        # 连接到SMTP服务器
-        if sender_email.endswith("gmail.com"):
-            server = smtplib.SMTP('smtp.gmail.com', 587)
-        elif sender_email.endswith("outlook.com") or sender_email.endswith("hotmail.com"):
-            server = smtplib.SMTP('smtp.office365.com', 587)
-        elif sender_email.endswith("yahoo.com"):
-            server = smtplib.SMTP('smtp.mail.yahoo.com', 587)
-        else:
-            # 默认使用Gmail，你可以根据需要修改
-            server = smtplib.SMTP('smtp.gmail.com', 587)
-        
-        server.starttls()  # 启用安全传输
-        server.login(sender_email, sender_password)
-        text = msg.as_string()
-        server.sendmail(sender_email, receiver_email, text)
-        server.quit()
+        _send(reporter, f"{symbol_name}股票分析 - {today}", html, {CHART_CID: chart_png})
         logger.info(f"邮件已成功发送到 {receiver_email}")
         return {"status": "success", "message": f"邮件已发送到 {receiver_email}"}
     except Exception as e:
         logger.error(f"发送邮件失败: {str(e)}")
         return {"status": "error", "message": f"发送邮件失败: {str(e)}"}
 
-def send_error_email(symbol, error, email_config):
+def send_error_email(symbol, error, email_config, reporter=None):
     """发送错误报告邮件"""
-    sender_email = email_config.get("from") or os.environ.get("EMAIL_FROM")
-    sender_password = email_config.get("password") or os.environ.get("EMAIL_PASSWORD")
-    receiver_email = email_config.get("to") or os.environ.get("EMAIL_TO")
+    if reporter is None:
+        with SmtpReporter(email_config) as reporter:
+            return send_error_email(symbol, error, email_config, reporter)
     
-    if not sender_email or not sender_password or not receiver_email:
+    if not reporter.configured:
         logger.error("邮箱配置缺失，无法发送错误邮件")
         return {"status": "error", "message": "邮箱配置缺失"}
     
-    msg = MIMEMultipart()
-    msg['From'] = sender_email
-    msg['To'] = receiver_email
-    msg['Subject'] = f"{symbol}股票分析 - 错误报告 - {datetime.now().strftime('%Y-%m-%d')}"
-    
-    error_content = f"""
-    <html>
-    <head>
-        <style>
-            body {{ font-family: Arial, sans-serif; }}
-            .error {{ color: red; font-weight: bold; }}
-        </style>
-    </head>
-    <body>
-        <h2>{symbol}股票分析 - 错误报告</h2>
-        <p class="error">执行脚本时发生错误:</p>
-        <p>{str(error)}</p>
-    </body>
-    </html>
-    """
-    
-    msg.attach(MIMEText(error_content, 'html'))
+    error_content = _ERROR_TEMPLATE.render(symbol=symbol, error=str(error))
     
     try:
-        if sender_email.endswith("gmail.com"):
-            server = smtplib.SMTP('smtp.gmail.com', 587)
-        elif sender_email.endswith("outlook.com"):
-            server = smtplib.SMTP('smtp.office365.com', 587)
-        else:
-            server = smtplib.SMTP('smtp.gmail.com', 587)
-            
-        server.starttls()
-        server.login(sender_email, sender_password)
-        server.sendmail(sender_email, receiver_email, msg.as_string())
-        server.quit()
+        _send(reporter, f"{symbol}股票分析 - 错误报告 - {datetime.now().strftime('%Y-%m-%d')}", error_content)
         logger.info("错误报告邮件已发送")
         return {"status": "success", "message": "错误报告邮件已发送"}
     except Exception as email_error:
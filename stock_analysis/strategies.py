@@ -1,79 +1,124 @@
 """买入策略分析模块"""
 
 import logging
+import numpy as np
+import pandas as pd
 
 logger = logging.getLogger(__name__)
 
-def analyze_buy_strategy(data, strategy_params=None):
+DEFAULT_STRATEGY_PARAMS = {
+    "rsi_threshold": 30,
+    "price_position_threshold": 33,
+    "ma_proximity_threshold": 0.05
+}
+
+# 市场位置评估：价格位置(%)的分档上界及对应描述，超过最后一档为最高档
+MARKET_POSITION_EDGES = [20, 40, 60, 80]
+MARKET_POSITION_LABELS = [
+    "接近历史低点，可能被低估",
+    "处于较低位置，可能具有一定价值",
+    "处于中间位置，价格适中",
+    "处于较高位置，可能面临回调风险",
+    "接近历史高点，可能被高估"
+]
+
+def analyze_buy_strategy_batch(df_latest, strategy_params=None):
     """
-    根据股票的数据分析是否适合买入
-    返回买入策略分析结果
+    批量分析多只股票是否适合买入
+    df_latest每行为一只股票的最新数据，需包含current_price、high_52_week、
+    low_52_week、ma50、ma200、rsi列；返回按行对应的策略分析结果DataFrame
     """
     if strategy_params is None:
-        strategy_params = {
-            "rsi_threshold": 30,
-            "price_position_threshold": 33,
-            "ma_proximity_threshold": 0.05
-        }
-    
-    current_price = data["current_price"]
-    high_52_week = data["high_52_week"]
-    low_52_week = data["low_52_week"]
-    ma50 = data["ma50"]
-    ma200 = data["ma200"]
-    rsi = data["rsi"]
-    
+        strategy_params = DEFAULT_STRATEGY_PARAMS
+    rsi_threshold = strategy_params.get("rsi_threshold", 30)
+    price_position_threshold = strategy_params.get("price_position_threshold", 33)
+    ma_proximity_threshold = strategy_params.get("ma_proximity_threshold", 0.05)
+
+    current_price = df_latest["current_price"].to_numpy(dtype=np.float64)
+    high_52_week = df_latest["high_52_week"].to_numpy(dtype=np.float64)
+    low_52_week = df_latest["low_52_week"].to_numpy(dtype=np.float64)
+    ma50 = df_latest["ma50"].to_numpy(dtype=np.float64)
+    ma200 = df_latest["ma200"].to_numpy(dtype=np.float64)
+    rsi = df_latest["rsi"].to_numpy(dtype=np.float64)
+
     # 计算当前价格相对于52周范围的位置（0-100%）
-    price_position = (current_price - low_52_week) / (high_52_week - low_52_week) * 100
-    
-    # 初始化买入信号
-    buy_signals = []
-    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        price_position = (current_price - low_52_week) / (high_52_week - low_52_week) * 100
+        ma_distance = np.abs(current_price - ma50) / ma50
+
     # 策略1: RSI < threshold 表示超卖，可能是买入机会
-    rsi_threshold = strategy_params.get("rsi_threshold", 30)
-    if rsi < rsi_threshold:
-        buy_signals.append(f"RSI低于{rsi_threshold}，处于超卖区域")
-    
+    rsi_signal = rsi < rsi_threshold
     # 策略2: 价格低于50日均线但高于200日均线，可能是技术回调
-    if current_price < ma50 and current_price > ma200:
-        buy_signals.append("价格低于50日均线但高于200日均线，可能是技术回调")
-    
+    pullback_signal = (current_price < ma50) & (current_price > ma200)
     # 策略3: 价格在52周范围的下1/3位置
-    price_position_threshold = strategy_params.get("price_position_threshold", 33)
-    if price_position < price_position_threshold:
-        buy_signals.append(f"价格在52周范围的下{price_position_threshold}%位置 ({price_position:.2f}%)")
-    
+    position_signal = price_position < price_position_threshold
     # 策略4: 50日均线在200日均线之上（黄金交叉后的走势）且价格在50日均线附近
-    ma_proximity_threshold = strategy_params.get("ma_proximity_threshold", 0.05)
-    if ma50 > ma200 and abs(current_price - ma50) / ma50 < ma_proximity_threshold:
-        buy_signals.append("均线呈现黄金交叉形态，且价格在50日均线附近")
-    
+    golden_cross_signal = (ma50 > ma200) & (ma_distance < ma_proximity_threshold)
+
+    # 各策略信号组成布尔矩阵（每行一只股票，每列一个策略），信号数量按行求和
+    signal_mask = np.column_stack([rsi_signal, pullback_signal, position_signal, golden_cross_signal])
+    signals_count = signal_mask.sum(axis=1)
+
     # 买入建议
-    recommendation = "不建议买入"
-    if len(buy_signals) >= 2:
-        recommendation = "可以考虑买入"
-    elif len(buy_signals) == 1:
-        recommendation = "观望"
-    
+    recommendation = np.select(
+        [signals_count >= 2, signals_count == 1],
+        ["可以考虑买入", "观望"],
+        default="不建议买入"
+    )
+
     # 当前市场位置评估
-    if price_position < 20:
-        market_position = "接近历史低点，可能被低估"
-    elif price_position < 40:
-        market_position = "处于较低位置，可能具有一定价值"
-    elif price_position < 60:
-        market_position = "处于中间位置，价格适中"
-    elif price_position < 80:
-        market_position = "处于较高位置，可能面临回调风险"
-    else:
-        market_position = "接近历史高点，可能被高估"
-    
-    result = {
+    market_position = np.select(
+        [price_position < edge for edge in MARKET_POSITION_EDGES],
+        MARKET_POSITION_LABELS[:-1],
+        default=MARKET_POSITION_LABELS[-1]
+    )
+
+    # 生成买入信号描述：按信号矩阵中为真的列选取对应描述（{:.2f}处填入价格位置）
+    signal_labels = [
+        f"RSI低于{rsi_threshold}，处于超卖区域",
+        "价格低于50日均线但高于200日均线，可能是技术回调",
+        f"价格在52周范围的下{price_position_threshold}%位置 ({{:.2f}}%)",
+        "均线呈现黄金交叉形态，且价格在50日均线附近"
+    ]
+    buy_signals = [
+        [signal_labels[j].format(price_position[i]) for j in np.flatnonzero(row)]
+        for i, row in enumerate(signal_mask)
+    ]
+
+    return pd.DataFrame({
+        "rsi_signal": rsi_signal,
+        "pullback_signal": pullback_signal,
+        "position_signal": position_signal,
+        "golden_cross_signal": golden_cross_signal,
         "buy_signals": buy_signals,
-        "signals_count": len(buy_signals),
+        "signals_count": signals_count,
         "recommendation": recommendation,
         "market_position": market_position,
-        "price_position_percentage": round(price_position, 2)
+        "price_position_percentage": np.round(price_position, 2)
+    }, index=df_latest.index)
+
+def analyze_buy_strategy(data, strategy_params=None):
+    """
+    根据股票的数据分析是否适合买入
+    返回买入策略分析结果
+    """
+    df_latest = pd.DataFrame([{
+        "current_price": data["current_price"],
+        "high_52_week": data["high_52_week"],
+        "low_52_week": data["low_52_week"],
+        "ma50": data["ma50"],
+        "ma200": data["ma200"],
+        "rsi": data["rsi"]
+    }])
+    row = analyze_buy_strategy_batch(df_latest, strategy_params).iloc[0]
+
+    result = {
+        "buy_signals": row["buy_signals"],
+        "signals_count": int(row["signals_count"]),
+        "recommendation": str(row["recommendation"]),
+        "market_position": str(row["market_position"]),
+        "price_position_percentage": float(row["price_position_percentage"])
     }
-    
+
     logger.info(f"分析完成: {result['recommendation']}, 信号数量: {result['signals_count']}")
     return result
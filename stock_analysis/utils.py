@@ -1,10 +1,18 @@
 """工具函数模块"""
 
 import os
+import copy
 import logging
+import functools
 import yaml
 from datetime import datetime
 
+# 优先使用LibYAML的C实现解析配置文件
+try:
+    from yaml import CSafeLoader as _YamlLoader
+except ImportError:
+    from yaml import SafeLoader as _YamlLoader
+
 # 设置日志
 def setup_logging():
     """设置日志系统"""
@@ -18,15 +26,21 @@ def setup_logging():
     )
     return logging.getLogger("stock_analysis")
 
+@functools.lru_cache(maxsize=4)
+def _parse_config_file(config_file, mtime):
+    """解析配置文件，按路径和修改时间缓存结果"""
+    with open(config_file, 'r', encoding='utf-8') as f:
+        return yaml.load(f, Loader=_YamlLoader)
+
 def load_config(config_file="config.yaml"):
     """加载配置文件"""
     logger = logging.getLogger(__name__)
     
     try:
-        with open(config_file, 'r', encoding='utf-8') as f:
-            config = yaml.safe_load(f)
-            logger.info(f"成功加载配置文件: {config_file}")
-            return config
+        config = _parse_config_file(config_file, os.path.getmtime(config_file))
+        logger.info(f"成功加载配置文件: {config_file}")
+        # 返回副本，避免调用方修改缓存中的配置
+        return copy.deepcopy(config)
     except Exception as e:
         logger.error(f"加载配置文件失败: {str(e)}")
         # 返回默认配置
@@ -1,50 +1,84 @@
 """可视化模块"""
 
 import io
-import base64
-import matplotlib.pyplot as plt
+import threading
 import matplotlib.dates as mdates
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 
-def create_price_chart(df, symbol_name, days=30):
+from stock_analysis.constants import CHART_DAYS
+
+# 每个线程复用一份图表模板（Figure对象之间互不影响，无需全局锁）
+_chart_templates = threading.local()
+
+def _get_chart_template():
+    """获取当前线程的图表模板，首次调用时创建并设置固定样式"""
+    template = getattr(_chart_templates, "template", None)
+    if template is None:
+        # 输出分辨率和背景色在创建时确定，导出时直接调用Agg画布编码PNG
+        fig = Figure(figsize=(10, 6), dpi=80, facecolor='white')
+        FigureCanvasAgg(fig)  # 直接绑定Agg画布，不经过pyplot
+        ax = fig.subplots()
+
+        # 设置坐标轴标签
+        ax.set_xlabel('Date', fontsize=12)
+        ax.set_ylabel('Price (USD)', fontsize=12)
+
+        # 设置x轴日期格式
+        ax.xaxis.set_major_formatter(mdates.DateFormatter('%m-%d'))
+        ax.xaxis.set_major_locator(mdates.DayLocator(interval=5))  # 每5天显示一个日期
+        ax.tick_params(axis='x', labelrotation=45)
+
+        # 添加网格线
+        ax.grid(True, linestyle='--', alpha=0.7)
+
+        # 固定布局，代替每次调用tight_layout
+        fig.subplots_adjust(left=0.08, right=0.95, bottom=0.15, top=0.92)
+
+        template = (fig, ax)
+        _chart_templates.template = template
+    return template
+
+def create_price_chart(df, symbol_name, days=CHART_DAYS):
     """
-    创建过去30天的股价折线图，并返回Base64编码的图像
+    创建过去days天的股价折线图，并返回PNG图像数据
     """
     # 获取最近days天的数据
     recent_data = df.iloc[-days:]
     
-    # 创建图形
-    fig, ax = plt.subplots(figsize=(10, 6))
+    # 复用图表模板，清除上一次绘制的内容
+    fig, ax = _get_chart_template()
+    for artist in list(ax.lines) + list(ax.texts):
+        artist.remove()
+    
+    # 日期预先转换为matplotlib日期数值，直接传入numpy数组，省去每条曲线的单位转换
+    dates = mdates.date2num(recent_data.index.to_numpy())
     
     # 绘制收盘价折线图
-    ax.plot(recent_data.index, recent_data['close'], 'b-', linewidth=2, label='Close Price')
+    close = recent_data['close'].to_numpy()
+    ax.plot(dates, close, 'b-', linewidth=2, label='Close Price')
     
     # 绘制50日均线
     if 'ma50' in recent_data.columns:
-        ax.plot(recent_data.index, recent_data['ma50'], 'r--', linewidth=1.5, label='50-Day MA')
+        ax.plot(dates, recent_data['ma50'].to_numpy(), 'r--', linewidth=1.5, label='50-Day MA')
     
     # 绘制200日均线
     if 'ma200' in recent_data.columns:
-        ax.plot(recent_data.index, recent_data['ma200'], 'g--', linewidth=1.5, label='200-Day MA')
-    
-    # 设置图表标题和标签
-    ax.set_title(f'{symbol_name} Stock Price - Last {days} Days', fontsize=14)
-    ax.set_xlabel('Date', fontsize=12)
-    ax.set_ylabel('Price (USD)', fontsize=12)
+        ax.plot(dates, recent_data['ma200'].to_numpy(), 'g--', linewidth=1.5, label='200-Day MA')
     
-    # 设置x轴日期格式
-    ax.xaxis.set_major_formatter(mdates.DateFormatter('%m-%d'))
-    ax.xaxis.set_major_locator(mdates.DayLocator(interval=5))  # 每5天显示一个日期
-    plt.xticks(rotation=45)
+    # 根据新数据重新计算坐标范围
+    ax.relim()
+    ax.autoscale_view()
     
-    # 添加网格线
-    ax.grid(True, linestyle='--', alpha=0.7)
+    # 设置图表标题
+    ax.set_title(f'{symbol_name} Stock Price - Last {days} Days', fontsize=14)
     
     # 添加图例
     ax.legend(loc='best')
     
     # 添加最新收盘价标注
-    latest_date = recent_data.index[-1]
-    latest_price = recent_data['close'].iloc[-1]
+    latest_date = dates[-1]
+    latest_price = close[-1]
     ax.annotate(f'${latest_price:.2f}', 
                 xy=(latest_date, latest_price),
                 xytext=(10, 0),
@@ -53,20 +87,8 @@ def create_price_chart(df, symbol_name, days=30):
                 fontweight='bold',
                 color='blue')
     
-    # 自动调整布局
-    plt.tight_layout()
-    
-    # 将图表转换为Base64编码的图像
+    # 将图表编码为PNG
     buffer = io.BytesIO()
-    plt.savefig(buffer, format='png', dpi=100)
-    buffer.seek(0)
-    image_png = buffer.getvalue()
-    buffer.close()
-    
-    # 关闭图表，释放内存
-    plt.close(fig)
-    
-    # 转换为Base64字符串
-    image_base64 = base64.b64encode(image_png).decode('utf-8')
-    
-    return image_base64
+    # 邮件图表无需最高压缩率，低压缩级别可显著减少PNG编码时间
+    fig.canvas.print_png(buffer, pil_kwargs={'compress_level': 1, 'optimize': False})
+    return buffer.getvalue()